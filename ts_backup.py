@@ -9,85 +9,552 @@ backup as well.
 import argparse
 import sys
 import os
-from filecmp import dircmp
-import itertools
+import stat
+import errno
+from filecmp import DEFAULT_IGNORES
+import json
+import hashlib
+import multiprocessing
+import queue
+import threading
+from contextlib import contextmanager
 import shutil
-from datetime import datetime
-import traceback
-from functools import wraps
+import subprocess
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import argcomplete
 
+_DATE_TIME_FORM = '%Y-%m-%dT%H:%M:%S'
+# kinds of backup actions
+COPY = 'copy'
+CREATE_FOLDER = 'mkdir'
+REMOVE = 'remove'
+REMOVE_FOLDER = 'rmtree'
+# file compare modes
+SHALLOW = 'shallow'
+DEEP = 'deep'
+TRUST_FOLDER_MTIME = 'trust-folder-mtime'
+# module level aliases - saves attribute lookup per call in hot paths
+_isdir = os.path.isdir
+_remove = os.remove
+_copy2 = shutil.copy2
+_copystat = shutil.copystat
+_rmtree = shutil.rmtree
+_SEP = os.sep
+# folder diff and copy are I/O bound - use more threads than CPUs
+_IO_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+# folder compare/copy tasks submitted ahead per worker
+_PENDING_PER_WORKER = 2
+_UINT64_MASK = (1 << 64) - 1
+_HASH_CHUNK = 1024 * 1024
+# folder states of previous run are kept in backup root
+_SNAPSHOT_FILE_NAME = '.ts_backup_snapshot'
+_IGNORED_NAMES = frozenset(DEFAULT_IGNORES)
+# snapshot file is skipped in root folder pair only (as rsync --exclude=/name) - it would be written over anyway
+_ROOT_IGNORED_NAMES = _IGNORED_NAMES | {_SNAPSHOT_FILE_NAME, _SNAPSHOT_FILE_NAME + '.tmp'}
+# scandir on folder descriptor makes DirEntry.stat use fstatat
+_FOLDER_FD_SUPPORTED = hasattr(os, 'O_DIRECTORY') and os.scandir in os.supports_fd
+# non-blocking open does not change regular file reads, but named pipe opened for type check would block forever
+# (binary flag matters on Windows only - raw descriptors are opened in text mode there)
+_SOURCE_OPEN_FLAGS = os.O_RDONLY | getattr(os, 'O_NONBLOCK', 0) | getattr(os, 'O_BINARY', 0)
+_TARGET_OPEN_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+# small files are copied by single read+write, medium ones by shutil.copy2, large ones by copy_file_range
+_SMALL_FILE_MAX_SIZE = 64 * 1024
+_COPY_FILE_RANGE_MIN_SIZE = 1024 * 1024
+_COPY_FILE_RANGE_CHUNK = 1024 * 1024 * 1024
+# cross-filesystem copy or unsupported filesystem/kernel (copy_file_range or sendfile)
+_COPY_FILE_RANGE_FALLBACK_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL)
+# metadata of copied file can be set by descriptors from source stat already taken (shutil.copystat stats again)
+_METADATA_BY_FD = hasattr(os, 'listxattr') and os.utime in os.supports_fd and os.chmod in os.supports_fd
+# xattr errors ignored the same way as by shutil.copystat
+_XATTR_IGNORED_ERRORS = (errno.EPERM, errno.ENOTSUP, errno.ENODATA, errno.EINVAL, errno.EACCES)
+# block device flag (partitions have it in parent device folder)
+_ROTATIONAL_FLAG_FILES = ('/sys/dev/block/{0}:{1}/queue/rotational', '/sys/dev/block/{0}:{1}/../queue/rotational')
+
 
 class BackupShallowDiff:
     """
-    Compare recursively source anf target folders and detect what got updated.
+    Compare recursively source and target folders and detect what got updated. Folders are walked by background
+    thread and differences are streamed to walk() as soon as they are found.
+
+    Construction is cheap - nothing is listed or compared until walk() is iterated. Caller aborting early does not
+    pay for the whole walk either - once walk() generator is closed, no further folders are compared (only the ones
+    already in progress are finished).
     """
 
-    def __init__(self, source_folder, target_folder):
-        self._diff = dircmp(source_folder, target_folder)
-        # self._diff.report_full_closure()
-        # for subdir, subdiff in self._diff.subdirs.items():
-        #     print('subdir: {0} -> {1}'.format(subdir, subdiff))
+    def __init__(self, source_folder, target_folder, snapshot=None, workers=_IO_WORKERS, compare=SHALLOW):
+        """
+        :param source_folder: source folder (left side)
+        :param target_folder: target folder (right side)
+        :param snapshot: source folder states recorded by previous run (see folder_states), files of folders
+                         with unchanged state are not compared; None means compare everything
+        :param workers: number of folder pairs compared concurrently (stat calls in flight)
+        :param compare: SHALLOW - files are compared by (type, size, mtime), DEEP - files of the same type and size
+                        are compared by content digest instead of mtime, TRUST_FOLDER_MTIME - as SHALLOW, but files
+                        of folders having the same mtime on both sides (and the same names) are not compared (see
+                        folder_times)
+        """
+        # snapshot keys are source relative paths - child paths of source simply start with this prefix (source
+        # folder itself is walked by it as well)
+        self._source_prefix = folder_prefix(source_folder)
+        self._target_folder = target_folder
+        self._snapshot = snapshot
+        self._workers = workers
+        self._compare = compare
+        # complete once walk() is consumed
+        self.folder_states = {}
+        # folders found in sync (relative paths as folder_states) mapped to (atime_ns, mtime_ns) of source folder -
+        # once applied to target folders, the next TRUST_FOLDER_MTIME run skips them unless source folder changes
+        self.folder_times = {}
+
+    def _walk(self, action_batches, stop):
+        """
+        Walk source and target folders side by side and queue actions of every folder pair (and content of every
+        new folder, so that large new subtrees are listed in parallel as well). Folder pairs
+        are compared concurrently - listing and stat calls are I/O bound and release GIL. Only few tasks per worker
+        are submitted at once, the rest waits in depth-first stack (pool queue would otherwise hold every folder
+        of wide trees). Walk failure is queued as well (to be raised by consumer), queue is terminated by None.
+        Once stopped by consumer, no further folders are submitted and content is not compared.
+
+        :param action_batches: bounded queue of action lists (see walk()) - walk waits while consumer is behind
+        :param stop: event set by consumer once it does not take actions any more
+        """
+        try:
+            # stat in inode order (per side) - passed to every folder task
+            sort_inodes = (is_rotational(self._source_prefix), is_rotational(self._target_folder))
+            hash_candidates = []
+            with ThreadPoolExecutor(max_workers=self._workers) as pool:
+                max_pending = self._workers * _PENDING_PER_WORKER
+                folder_stack = [(self._diff_one_dir, self._source_prefix, self._target_folder)]
+                pending = set()
+                while (folder_stack or pending) and not stop.is_set():
+                    while folder_stack and len(pending) < max_pending:
+                        pending.add(pool.submit(*folder_stack.pop(), sort_inodes))
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        actions, subfolders, same_size_files = future.result()
+                        # subfolders are listed only after their CREATE_FOLDER actions are queued
+                        if actions:
+                            put_batch(action_batches, stop, actions)
+                        folder_stack.extend(subfolders)
+                        hash_candidates.extend(same_size_files)
+            if hash_candidates and not stop.is_set():
+                put_batch(action_batches, stop, compare_contents(hash_candidates))
+        except Exception as exc:
+            put_batch(action_batches, stop, exc)
+        finally:
+            put_batch(action_batches, stop, None)
+
+    def _diff_one_dir(self, left, right, sort_inodes):
+        """
+        Compare one pair of folders - each side is listed by single os.scandir call and files are compared
+        by (type, size, mtime) signature taken by stat of directory entries - target side signatures are collected
+        once per folder.
+
+        If snapshot is used and source folder has the same mtime and entry count as in previous run (and names
+        on both sides match) then file comparison is skipped. Subfolders are compared anyway as their changes
+        do not propagate to parent folder mtime. The same applies if trusting folder mtime and target folder has
+        the same mtime as source one (set by previous run once found in sync). Folder state and times are recorded
+        (see folder_states and folder_times) only if folder is found in sync.
+
+        On rotational disks files are stat-ed in inode order (inode tables are read sequentially instead of
+        seeking back and forth) - inode numbers come with folder listing.
+
+        In deep mode regular files of the same size are not compared by mtime but returned separately to get
+        compared by content.
 
-    def collect_updates(self):
+        Folder pair which can not be opened or listed (e.g. no permission or removed meanwhile) is logged and
+        skipped with its whole subtree - the rest of the walk goes on and nothing is recorded for it.
+
+        :param left: source folder
+        :param right: target folder
+        :param sort_inodes: (source, target) flags of stat in inode order
+        :return: tuple of (actions - see walk(), subfolder tasks, file pairs to be compared by content)
+        """
+        try:
+            # entries stat relatively to open folder descriptors - keep them open until compared
+            with open_folder(left) as left_folder, open_folder(right) as right_folder:
+                # taken before listing - change made meanwhile is caught by next run
+                left_stat = os.stat(left_folder) if self._snapshot is not None or \
+                    self._compare == TRUST_FOLDER_MTIME else None
+                folder_entries = self._scan_pair(left, left_folder, right_folder)
+                unchanged, folder_record = self._check_unchanged(left_stat, right_folder, folder_prefix(left),
+                                                                 *folder_entries)
+                actions, subfolders, common_files = self._split_entries(left, right, *folder_entries)
+                same_size_files = [] if unchanged else self._compare_files(common_files, actions, sort_inodes)
+        except OSError as exc:
+            logging.warning('! failed to compare %s -> %s: %s', left, right, exc)
+            return [], [], []
+        # record only folders in sync - changed ones get compared again by next run
+        if folder_record and not actions:
+            self._record_folder(*folder_record)
+        return actions, subfolders, same_size_files
+
+    def _scan_pair(self, left, left_folder, right_folder):
         """
-        :return: lazy iterable of tuples containing full source and target paths of changed files or folders
+        List both folders of folder pair, snapshot file names are skipped in root folder pair only
+
+        :param left: source folder path
+        :param left_folder: source folder (descriptor or path, see open_folder)
+        :param right_folder: target folder (descriptor or path)
+        :return: tuple of (source folder entries, target folder entries) - see scan_folder
         """
-        all_diff_files = []
-        diff_stack = [self._diff]
-        while diff_stack:
-            diff_cursor = diff_stack.pop()
-            file_chain = itertools.chain(diff_cursor.left_only, diff_cursor.diff_files)
-            all_diff_files.append(map(ParentPairJoiner(diff_cursor.left, diff_cursor.right).join, file_chain))
-            if diff_cursor.subdirs:
-                diff_stack.extend(diff_cursor.subdirs.values())
-        return itertools.chain(*all_diff_files)
+        ignored_names = _ROOT_IGNORED_NAMES if folder_prefix(left) == self._source_prefix else _IGNORED_NAMES
+        return scan_folder(left_folder, ignored_names), scan_folder(right_folder, ignored_names)
 
-    def collect_removals(self):
+    def _check_unchanged(self, left_stat, right_folder, left_prefix, left_entries, right_entries):
         """
-        :return: lazy iterable of files or folders to be removed (right side means backup side)
+        Check whether files of folder pair can be taken as in sync without comparing them - by snapshot of previous
+        run or by the same mtime of target folder, names on both sides have to match in both cases
+
+        :param left_stat: stat of source folder taken before listing it or None if neither check is used
+        :param right_folder: target folder (descriptor or path, see open_folder)
+        :param left_prefix: source folder path with trailing separator
+        :param left_entries: source folder entries (see scan_folder)
+        :param right_entries: target folder entries
+        :return: tuple of (unchanged flag, (folder key, state or None, times or None) or None) - the latter is to be
+                 recorded only if folder is found in sync (see _record_folder)
         """
-        all_removed_files = []
-        diff_stack = [self._diff]
-        while diff_stack:
-            diff_cursor = diff_stack.pop()
-            all_removed_files.append(map(ParentJoiner(diff_cursor.right).join, diff_cursor.right_only))
-            if diff_cursor.subdirs:
-                diff_stack.extend(diff_cursor.subdirs.values())
-        return itertools.chain(*all_removed_files)
+        if left_stat is None or left_entries.keys() != right_entries.keys():
+            # different names mean actions - nothing to record
+            return False, None
+        folder_key = left_prefix[len(self._source_prefix):-1] or os.curdir
+        unchanged = False
+        folder_state = None
+        folder_time = None
+        if self._compare == TRUST_FOLDER_MTIME:
+            unchanged = os.stat(right_folder).st_mtime_ns == left_stat.st_mtime_ns
+            if not unchanged:
+                folder_time = (left_stat.st_atime_ns, left_stat.st_mtime_ns)
+        if self._snapshot is not None:
+            folder_state = (left_stat.st_mtime_ns, len(left_entries))
+            unchanged = unchanged or self._snapshot.get(folder_key) == folder_state
+        return unchanged, (folder_key, folder_state, folder_time)
+
+    def _record_folder(self, folder_key, folder_state, folder_time):
+        """
+        Record state/times of folder found in sync - runs on walk pool threads (single dict item assignment)
 
+        :param folder_key: source relative folder path
+        :param folder_state: (mtime_ns, entry count) of source folder or None
+        :param folder_time: (atime_ns, mtime_ns) of source folder or None
+        """
+        if folder_state is not None:
+            self.folder_states[folder_key] = folder_state
+        if folder_time is not None:
+            self.folder_times[folder_key] = folder_time
 
-class ParentJoiner:
-    """
-    Provide path + child joining - suitable for lazy operations.
-    """
+    def _split_entries(self, left, right, left_entries, right_entries):
+        """
+        Sort out entries of folder pair - entries present on one side only are turned to actions right away
+
+        :param left: source folder
+        :param right: target folder
+        :param left_entries: source folder entries (see scan_folder)
+        :param right_entries: target folder entries
+        :return: tuple of (actions - see walk(), subfolder tasks, list of common files as (source, target,
+                 source os.DirEntry, target os.DirEntry) tuples)
+        """
+        left_prefix = folder_prefix(left)
+        right_prefix = folder_prefix(right)
+        actions = []
+        subfolders = []
+        common_files = []
+        for name, left_entry in left_entries.items():
+            right_entry = right_entries.get(name)
+            left_is_dir = left_entry.is_dir()
+            if right_entry is None:
+                if left_is_dir:
+                    actions.append((CREATE_FOLDER, left_prefix + name, right_prefix + name))
+                    subfolders.append((self._list_new_dir, left_prefix + name, right_prefix + name))
+                else:
+                    actions.append((COPY, left_prefix + name, right_prefix + name))
+            # folder vs. file conflict is left untouched (same as dircmp.common_funny)
+            elif left_is_dir == right_entry.is_dir():
+                if left_is_dir:
+                    subfolders.append((self._diff_one_dir, left_prefix + name, right_prefix + name))
+                else:
+                    common_files.append((left_prefix + name, right_prefix + name, left_entry, right_entry))
+        for name in right_entries.keys() - left_entries.keys():
+            # type is known from folder listing - symbolic link to folder gets removed as file
+            kind = REMOVE_FOLDER if right_entries[name].is_dir(follow_symlinks=False) else REMOVE
+            actions.append((kind, None, right_prefix + name))
+        return actions, subfolders, common_files
+
+    def _compare_files(self, common_files, actions, sort_inodes):
+        """
+        Compare files present on both sides by signatures - whole folder at once. Files not accessible on either
+        side (e.g. broken link) are left untouched (same as dircmp.common_funny).
 
-    def __init__(self, parent_path):
-        self._parent_path = parent_path
+        :param common_files: list of (source, target, source os.DirEntry, target os.DirEntry) tuples
+        :param actions: list to append COPY actions of changed files to
+        :param sort_inodes: (source, target) flags of stat in inode order
+        :return: list of (source, target) pairs to be compared by content (deep mode only)
+        """
+        sort_left, sort_right = sort_inodes
+        right_files = common_files
+        if sort_right:
+            right_files = sorted(common_files, key=lambda files: files[3].inode())
+        if sort_left:
+            common_files.sort(key=lambda files: files[2].inode())
+        # signatures are keyed by source path - common files are matched by it
+        right_signatures = {file_left: entry_signature(right_entry) for file_left, _, _, right_entry in right_files}
+        left_signatures = {
+            file_left: entry_signature(left_entry)
+            for file_left, _, left_entry, _ in common_files if right_signatures[file_left] is not None
+        }
+        targets = {file_left: file_right for file_left, file_right, _, _ in common_files}
+        if self._compare != DEEP:
+            # pairs of (source, signature) not found on target side - compared in C
+            actions.extend(
+                (COPY, file_left, targets[file_left])
+                for file_left, signature in left_signatures.items() - right_signatures.items() if signature is not None
+            )
+            return []
+        same_size_files = []
+        for file_left, signature in left_signatures.items():
+            if signature is None:
+                continue
+            if signature >> 64 != right_signatures[file_left] >> 64:
+                actions.append((COPY, file_left, targets[file_left]))
+            elif stat.S_ISREG(signature >> 128):
+                same_size_files.append((file_left, targets[file_left]))
+            # named pipes and devices have no content to hash (open would block) - compared by mtime as in shallow
+            elif signature != right_signatures[file_left]:
+                actions.append((COPY, file_left, targets[file_left]))
+        return same_size_files
+
+    def _list_new_dir(self, left, right, _sort_inodes):
+        """
+        List content of folder existing only on source side, so that it can be copied file by file - one level
+        only, new subfolders are listed by further tasks. Nothing is ignored here (same as shutil.copytree used
+        to do).
 
-    def join(self, child_path):
+        :param left: new source folder
+        :param right: target folder (created by preceding CREATE_FOLDER action)
+        :return: tuple of (CREATE_FOLDER and COPY actions, subfolder tasks, []) - same as _diff_one_dir
+        """
+        actions = []
+        subfolders = []
+        left_prefix = folder_prefix(left)
+        right_prefix = folder_prefix(right)
+        try:
+            with os.scandir(left) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        actions.append((CREATE_FOLDER, left_prefix + entry.name, right_prefix + entry.name))
+                        subfolders.append((self._list_new_dir, left_prefix + entry.name, right_prefix + entry.name))
+                    else:
+                        actions.append((COPY, left_prefix + entry.name, right_prefix + entry.name))
+        except OSError as exc:
+            logging.warning('! failed to list %s: %s', left, exc)
+        return actions, subfolders, []
+
+    def walk(self):
         """
-        :param child_path: child file or folder name
-        :return: parent path joined with child (plain file or folder name)
+        Single pass over all differences. Actions are (kind, source, target) tuples:
+         - (COPY, source file, target file) - new or changed file
+         - (CREATE_FOLDER, source folder, target folder) - new folder, always precedes its content
+         - (REMOVE, None, target file) - not present in source any more
+         - (REMOVE_FOLDER, None, target folder) - not present in source any more (to be removed recursively)
+        Removed paths never overlap copied ones, so actions of different kinds do not depend on each other.
+
+        :return: generator of actions - folders are walked by background thread started on first iteration and
+                 stopped once generator is closed (or garbage collected) before walk is complete
         """
-        return os.path.join(self._parent_path, child_path)
+        # few folders ahead of consumer - walk does not pile up actions while copies are behind
+        action_batches = queue.Queue(maxsize=self._workers * _PENDING_PER_WORKER)
+        stop = threading.Event()
+        threading.Thread(target=self._walk, args=(action_batches, stop), daemon=True).start()
+        yield from drain_batches(action_batches, stop)
 
 
-class ParentPairJoiner:
+def entry_signature(entry):
     """
-    Provide path +child joining in pairs (source, target) - suitable for lazy operations.
+    Pack (file type, size, mtime) of entry into single int - comparison is then one int compare with no tuple
+    allocation. Packing is lossless: size takes 64 bits and signed mtime_ns (as unsigned) fits into 64 bits below
+    it, so signature >> 64 is (file type, size) part.
+
+    :param entry: os.DirEntry
+    :return: signature or None if entry can not be stat-ed
     """
+    try:
+        entry_stat = entry.stat()
+    except OSError:
+        return None
+    return (stat.S_IFMT(entry_stat.st_mode) << 128) | (entry_stat.st_size << 64) | \
+        (entry_stat.st_mtime_ns & _UINT64_MASK)
 
-    def __init__(self, parent_left_path, parent_right_path):
-        self._parent_left_path_joiner = ParentJoiner(parent_left_path)
-        self._parent_right_path_joiner = ParentJoiner(parent_right_path)
 
-    def join(self, child_path):
-        """
-        :param child_path: child file or folder name
-        :return: tuple with (left, right) parent path joined with child (plain file or folder name)
-        """
-        return self._parent_left_path_joiner.join(child_path), self._parent_right_path_joiner.join(child_path)
+def hash_file(file_path):
+    """
+    :param file_path: file to read
+    :return: sha256 digest of file content (hashlib uses OpenSSL with SHA extensions where available)
+    """
+    with open(file_path, 'rb') as file:
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(file, 'sha256').digest()
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: file.read(_HASH_CHUNK), b''):
+            digest.update(chunk)
+        return digest.digest()
+
+
+def hash_pair(file_pair):
+    """
+    Compare content of two files - runs in worker process
+
+    :param file_pair: (source, target) file paths
+    :return: (file pair, True if contents equal or None if any of files can not be read)
+    """
+    try:
+        return file_pair, hash_file(file_pair[0]) == hash_file(file_pair[1])
+    except OSError:
+        return file_pair, None
+
+
+def compare_contents(file_pairs):
+    """
+    Compare file pairs by content digest - hashing is CPU bound so it runs in process pool (not limited by GIL)
+
+    :param file_pairs: (source, target) file paths
+    :return: list of COPY actions (see BackupShallowDiff.walk) of pairs with different content
+    """
+    diff_files = []
+    # spawn - forking while walker and copy threads run is not safe
+    with multiprocessing.get_context('spawn').Pool(os.cpu_count()) as pool:
+        for (file_left, file_right), equal in pool.imap_unordered(hash_pair, file_pairs, chunksize=64):
+            if equal is None:
+                logging.warning('! failed to compare content %s -> %s', file_left, file_right)
+            elif not equal:
+                diff_files.append((COPY, file_left, file_right))
+    return diff_files
+
+
+def drain_batches(batches, stop):
+    """
+    :param batches: queue of item lists terminated by None (exception is raised)
+    :param stop: event set once generator is closed or done (see put_batch)
+    :return: generator of items as soon as their batch is queued
+    """
+    try:
+        while True:
+            batch = batches.get()
+            if batch is None:
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            yield from batch
+    finally:
+        stop.set()
+        # producer blocked on full queue wakes up and sees stop (only this consumer takes from queue)
+        while not batches.empty():
+            batches.get_nowait()
+
+
+def put_batch(batches, stop, batch):
+    """
+    Queue batch unless consumer stopped - stop is checked before every put, so at most one put follows emptying
+    of the queue by stopped consumer (see drain_batches) and it does not block
+
+    :param batches: bounded queue
+    :param stop: event set by stopped consumer
+    :param batch: item list, exception or None (end of batches)
+    """
+    if not stop.is_set():
+        batches.put(batch)
+
+
+def scan_folder(folder, ignored_names=_IGNORED_NAMES):
+    """
+    List folder content using single os.scandir call
+
+    :param folder: folder (path or descriptor) to list
+    :param ignored_names: names to skip - names ignored by dircmp, plus snapshot file in root folders
+    :return: dict of entry names mapped to os.DirEntry
+    """
+    with os.scandir(folder) as entries:
+        return {entry.name: entry for entry in entries if entry.name not in ignored_names}
+
+
+def load_snapshot(target_folder):
+    """
+    :param target_folder: backup root
+    :return: folder states stored by previous run or empty dict if there is none or it is not readable (everything
+             gets compared then and the snapshot is replaced at the end of run)
+    """
+    snapshot_path = os.path.join(target_folder, _SNAPSHOT_FILE_NAME)
+    try:
+        with open(snapshot_path, encoding='utf-8') as snapshot_file:
+            return {folder: tuple(state) for folder, state in json.load(snapshot_file).items()}
+    except FileNotFoundError:
+        return {}
+    except (ValueError, AttributeError, TypeError) as exc:
+        logging.warning('! ignoring broken snapshot %s: %s', snapshot_path, exc)
+        return {}
+
+
+def save_snapshot(target_folder, folder_states):
+    """
+    Store folder states into backup root (replaced atomically)
+
+    :param target_folder: backup root
+    :param folder_states: {relative source folder path: (mtime_ns, entry count)}
+    """
+    snapshot_path = os.path.join(target_folder, _SNAPSHOT_FILE_NAME)
+    with open(snapshot_path + '.tmp', 'w', encoding='utf-8') as snapshot_file:
+        json.dump(folder_states, snapshot_file)
+    os.replace(snapshot_path + '.tmp', snapshot_path)
+
+
+@contextmanager
+def open_folder(folder):
+    """
+    Open folder descriptor (POSIX only) - listing it and stat of its entries are then resolved relatively to it
+    instead of walking the whole path again for every entry.
+
+    :param folder: folder path
+    :return: context manager of folder descriptor (closed on exit) or unchanged folder path where descriptors are
+             not supported
+    """
+    if not _FOLDER_FD_SUPPORTED:
+        yield folder
+        return
+    folder_fd = os.open(folder, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        yield folder_fd
+    finally:
+        os.close(folder_fd)
+
+
+def folder_prefix(folder):
+    """
+    :param folder: existing folder
+    :return: folder path with trailing separator - child name can be simply appended (no need for os.path.join)
+    """
+    return folder if folder.endswith(_SEP) else folder + _SEP
+
+
+def is_rotational(folder):
+    """
+    Check whether folder is stored on rotational disk (Linux only)
+
+    :param folder: existing folder
+    :return: True if block device of folder reports rotational flag, False if not or unknown (e.g. network or
+             virtual file system)
+    """
+    try:
+        device = os.stat(folder).st_dev
+    except OSError:
+        return False
+    for flag_file in _ROTATIONAL_FLAG_FILES:
+        try:
+            with open(flag_file.format(os.major(device), os.minor(device)), encoding='utf-8') as flag:
+                return flag.read().strip() == '1'
+        except OSError:
+            continue
+    return False
 
 
 def check_and_create_folder(target: str, dry_run=False):
@@ -97,115 +564,436 @@ def check_and_create_folder(target: str, dry_run=False):
     :param dry_run: simulate if true
     :param target: folder to check
     """
-    if not os.path.isdir(target):
+    if not _isdir(target):
         if dry_run:
-            sys.stderr.write('.. need to create target folder: {0}\n'.format(_TARGET_PATH))
+            sys.stderr.write('.. need to create target folder: {0}\n'.format(target))
         else:
-            sys.stderr.write('.. creating target folder: {0}\n'.format(_TARGET_PATH))
-            os.mkdir(_TARGET_PATH)
+            sys.stderr.write('.. creating target folder: {0}\n'.format(target))
+            os.mkdir(target)
 
 
-def safe_action(message):
+def do_copy(file_source, file_target):
     """
-    Expose message value to inner decorator
+    Copy file from source to target
 
-    :param message: message seed in case of exception
-    :return: try-except-log decorator
+    :param file_source: source file
+    :param file_target: target file
     """
-    def decorator(func):
-        """
-        Wraps risky method into wrapper
+    if not copy_regular_file(file_source, file_target):
+        _copy2(file_source, file_target)
 
-        :param func: original callable
-        :return: try-except-log wrapper
-        """
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            """
-            Surround func with try-except-log blocks
 
-            :param args:
-            :param kwargs:
-            :return: wrapped callable
-            """
-            try:
-                func(*args, **kwargs)
-            except Exception:
-                print('! [{0}] '.format(func.__name__) + message.format(*args))
-                print(traceback.format_exc())
+def copy_regular_file(file_source, file_target):
+    """
+    Copy regular file content the cheapest way for its size and preserve metadata the same way as shutil.copy2 does:
+    small files by plain read and write (no shutil.copyfile checks costing several extra stat calls), large
+    files by os.copy_file_range. Metadata are taken from the source stat used for the size decision.
 
-        return wrapper
-    return decorator
+    :param file_source: source file
+    :param file_target: target file
+    :return: False if file is not eligible or copy_file_range is not usable (caller should fall back)
+    """
+    source_fd = os.open(file_source, _SOURCE_OPEN_FLAGS)
+    try:
+        source_stat = os.fstat(source_fd)
+        if not stat.S_ISREG(source_stat.st_mode):
+            return False
+        if source_stat.st_size <= _SMALL_FILE_MAX_SIZE:
+            copy_content = copy_small_content
+        elif source_stat.st_size >= _COPY_FILE_RANGE_MIN_SIZE and hasattr(os, 'copy_file_range'):
+            copy_content = copy_content_range
+        else:
+            return False
+        target_fd = os.open(file_target, _TARGET_OPEN_FLAGS, 0o666)
+        try:
+            if not copy_content(source_fd, target_fd):
+                return False
+            if _METADATA_BY_FD:
+                copy_metadata(source_fd, target_fd, source_stat)
+        finally:
+            os.close(target_fd)
+    finally:
+        os.close(source_fd)
+    if not _METADATA_BY_FD:
+        _copystat(file_source, file_target)
+    return True
+
+
+def copy_metadata(source_fd, target_fd, source_stat):
+    """
+    Preserve extended attributes, times and permission bits the same way as shutil.copystat does, but by open
+    descriptors and from already taken source stat - no extra stat call and no path lookups
 
+    :param source_fd: source file descriptor
+    :param target_fd: target file descriptor
+    :param source_stat: stat result of source file
+    """
+    try:
+        names = os.listxattr(source_fd)
+    except OSError as exc:
+        if exc.errno not in (errno.ENOTSUP, errno.ENODATA, errno.EINVAL):
+            raise
+        names = []
+    for name in names:
+        try:
+            os.setxattr(target_fd, name, os.getxattr(source_fd, name))
+        except OSError as exc:
+            if exc.errno not in _XATTR_IGNORED_ERRORS:
+                raise
+    os.utime(target_fd, ns=(source_stat.st_atime_ns, source_stat.st_mtime_ns))
+    os.chmod(target_fd, stat.S_IMODE(source_stat.st_mode))
+
+
+def copy_small_content(source_fd, target_fd):
+    """
+    Copy content of small file - usually one write (file may have grown meanwhile, so read until EOF)
 
-@safe_action('failed to copy {0} -> {1}')
-def do_copy(file_source, file_target):
+    :param source_fd: source file descriptor
+    :param target_fd: target file descriptor
+    :return: True
     """
-    Copy file or folder from source to target
+    while True:
+        data = os.read(source_fd, _SMALL_FILE_MAX_SIZE + 1)
+        # short read does not have to mean EOF (e.g. FUSE direct_io) - only empty one does
+        if not data:
+            return True
+        remaining = memoryview(data)
+        while remaining:
+            remaining = remaining[os.write(target_fd, remaining):]
 
-    :param file_source: source file or folder
-    :param file_target: target file or folder
+
+def copy_content_range(source_fd, target_fd):
     """
-    if os.path.isdir(file_source):
-        shutil.copytree(file_source, file_target)
-    else:
-        shutil.copy2(file_source, file_target)
+    Copy content by os.copy_file_range - data stay in kernel (or get reflinked on CoW filesystems). If refused
+    right away (e.g. cross-filesystem on some kernels) then os.sendfile is tried - still no user space copy.
+
+    :param source_fd: source file descriptor
+    :param target_fd: target file descriptor
+    :return: False if neither copy_file_range nor sendfile is usable
+    """
+    return copy_in_kernel(os.copy_file_range, source_fd, target_fd) or \
+        (hasattr(os, 'sendfile') and copy_in_kernel(sendfile, source_fd, target_fd))
+
+
+def sendfile(source_fd, target_fd, count):
+    """
+    os.sendfile with copy_file_range like signature (copies from current file position)
+    """
+    return os.sendfile(target_fd, source_fd, None, count)
+
 
+def copy_in_kernel(copy_chunk, source_fd, target_fd):
+    """
+    Copy content chunk by chunk until EOF
 
-@safe_action('failed to remove {0}')
-def do_remove(file_target):
+    :param copy_chunk: os.copy_file_range like callable
+    :param source_fd: source file descriptor
+    :param target_fd: target file descriptor
+    :return: False if the very first chunk is refused (nothing copied - caller may try another way)
+    """
+    copied = 0
+    while True:
+        try:
+            chunk = copy_chunk(source_fd, target_fd, _COPY_FILE_RANGE_CHUNK)
+        except OSError as exc:
+            if copied == 0 and exc.errno in _COPY_FILE_RANGE_FALLBACK_ERRORS:
+                return False
+            raise
+        if not chunk:
+            return True
+        copied += chunk
+
+
+def do_remove(file_target, is_dir):
     """
     Remove file or folder (recursively)
 
-    :param file_target: source file or folder
+    :param file_target: target file or folder
+    :param is_dir: folder flag (as found by walk - no need to stat again)
     """
-    if os.path.isdir(file_target):
-        shutil.rmtree(file_target)
+    if is_dir:
+        _rmtree(file_target)
     else:
-        os.remove(file_target)
+        _remove(file_target)
 
 
-if __name__ == '__main__':
-    _PARSER = argparse.ArgumentParser(description='One-shot backup of projects using shallow file compare.')
-    _PARSER.add_argument('--source', type=str, required=True,
-                         help='source folder (with living data inside)')
-    _PARSER.add_argument('--backup-root', type=str, required=True,
-                         help='target folder (with backups)')
-    _PARSER.add_argument('--dry-run', action='store_true',
-                         help='just show what would be copied - no change on file system')
-    _PARSER.add_argument('--verbose', action='store_true',
-                         help='show verbose output')
-
-    argcomplete.autocomplete(_PARSER)
-    _ARGS = _PARSER.parse_args()
-    _DATE_TIME_FORM = '%Y-%m-%dT%H:%M:%S'
-    print(' {0} '.format(datetime.strftime(datetime.now(), _DATE_TIME_FORM)).center(35, 'v'))
-
-    if _ARGS.verbose:
-        sys.stderr.write('#args: {0}\n'.format(_ARGS))
-
-    _SOURCE_PATH = os.path.abspath(_ARGS.source)
-    _TARGET_PATH = os.path.abspath(_ARGS.backup_root)
-    if _ARGS.verbose:
-        sys.stderr.write('#source_path: {0}\n'.format(_SOURCE_PATH))
-        sys.stderr.write('#target_path: {0}\n'.format(_TARGET_PATH))
-
-    check_and_create_folder(_TARGET_PATH, dry_run=_ARGS.dry_run)
-
-    _DIFF = BackupShallowDiff(_SOURCE_PATH, _TARGET_PATH)
-    # copy+update
-    for file_left, file_right in _DIFF.collect_updates():
-        if _ARGS.dry_run:
-            print('backup [dry-run]: {0}\n               -> {1}'.format(file_left, file_right))
-        else:
-            print('backup: {0}\n     -> {1}'.format(file_left, file_right))
-            do_copy(file_left, file_right)
-    # remove
-    for doomed_file_right in _DIFF.collect_removals():
-        if _ARGS.dry_run:
-            print('REMOVE [dry-run]: {0}'.format(doomed_file_right))
+def run_rsync(source_folder, target_folder, dry_run=False):
+    """
+    Synchronize target folder with source folder by rsync (size and mtime based quick check as well) - the same
+    names are skipped as by built-in compare (excluded files are not deleted from target either)
+
+    :param source_folder: source folder
+    :param target_folder: target folder
+    :param dry_run: only list changes (rsync -n)
+    :return: rsync exit code
+    """
+    command = ['rsync', '-a', '--delete']
+    command += ['--exclude=' + name for name in sorted(_IGNORED_NAMES)]
+    command += ['--exclude=/' + name for name in sorted(_ROOT_IGNORED_NAMES - _IGNORED_NAMES)]
+    if dry_run:
+        command += ['--dry-run', '--itemize-changes']
+    command += [folder_prefix(source_folder), folder_prefix(target_folder)]
+    sys.stdout.flush()
+    return subprocess.run(command, check=False).returncode
+
+
+def bounded_submitter(pool, max_pending):
+    """
+    Wrap pool submit so that caller blocks while max_pending tasks are queued or running - together with bounded
+    action queue of walk keeps memory flat when walk produces faster than workers copy (same as folder tasks of walk,
+    caller is single thread)
+
+    :param pool: executor
+    :param max_pending: maximal number of unfinished tasks
+    :return: submit(task, *args) callable
+    """
+    pending = set()
+
+    def submit(task, *task_args):
+        if len(pending) >= max_pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            pending.difference_update(done)
+        pending.add(pool.submit(task, *task_args))
+
+    return submit
+
+
+def copy_task(file_source, file_target, failed_copies):
+    """
+    Copy file on worker thread - failure is logged so that other copies go on (traceback only for unexpected
+    errors - file system errors are common and self-explaining)
+
+    :param file_source: source file
+    :param file_target: target file
+    :param failed_copies: list collecting target files of failed copies
+    """
+    try:
+        do_copy(file_source, file_target)
+    except OSError as exc:
+        failed_copies.append(file_target)
+        logging.warning('! failed to copy %s -> %s: %s', file_source, file_target, exc)
+    except Exception:
+        failed_copies.append(file_target)
+        logging.exception('! failed to copy %s -> %s', file_source, file_target)
+
+
+def remove_task(file_target, is_dir):
+    """
+    Remove file or folder on worker thread - failure is logged so that other removals go on (traceback only for
+    unexpected errors)
+
+    :param file_target: file or folder to remove
+    :param is_dir: folder flag
+    """
+    try:
+        do_remove(file_target, is_dir)
+    except OSError as exc:
+        logging.warning('! failed to remove %s: %s', file_target, exc)
+    except Exception:
+        logging.exception('! failed to remove %s', file_target)
+
+
+def dry_run_handlers():
+    """
+    :return: dict of action kinds (see BackupShallowDiff.walk) mapped to handler(source, target) just showing
+             what would be done
+    """
+    # bound once - every action costs just format and write call (no print machinery)
+    write = sys.stdout.write
+    format_backup = 'backup [dry-run]: {0}\n               -> {1}\n'.format
+    format_remove = 'REMOVE [dry-run]: {0}\n'.format
+
+    def show_backup(file_left, file_right):
+        write(format_backup(file_left, file_right))
+
+    def show_remove(_file_left, file_right):
+        write(format_remove(file_right))
+
+    return {COPY: show_backup, CREATE_FOLDER: show_backup, REMOVE: show_remove, REMOVE_FOLDER: show_remove}
+
+
+def backup_handlers(submit, new_folders, failed_copies):
+    """
+    :param submit: submit(task, *args) callable of copy/remove pool
+    :param new_folders: list collecting (source, target) pairs of created folders (their metadata are to be copied
+                        once their content is copied)
+    :param failed_copies: list collecting target files of failed copies (filled by copy workers)
+    :return: dict of action kinds (see BackupShallowDiff.walk) mapped to handler(source, target)
+    """
+    write = sys.stdout.write
+    format_backup = 'backup: {0}\n     -> {1}\n'.format
+    format_remove = 'REMOVE: {0}\n'.format
+
+    def copy(file_left, file_right):
+        write(format_backup(file_left, file_right))
+        submit(copy_task, file_left, file_right, failed_copies)
+
+    def create_folder(file_left, file_right):
+        write(format_backup(file_left, file_right))
+        # new folder is created right away - its content follows
+        try:
+            os.mkdir(file_right)
+            new_folders.append((file_left, file_right))
+        except OSError as exc:
+            logging.warning('! failed to create folder %s: %s', file_right, exc)
+
+    def remove(_file_left, file_right):
+        write(format_remove(file_right))
+        submit(remove_task, file_right, False)
+
+    def remove_folder(_file_left, file_right):
+        write(format_remove(file_right))
+        submit(remove_task, file_right, True)
+
+    return {COPY: copy, CREATE_FOLDER: create_folder, REMOVE: remove, REMOVE_FOLDER: remove_folder}
+
+
+def copy_folder_metadata(new_folders, failed_copies):
+    """
+    Copy metadata of created folders (like shutil.copytree) - once their content is copied. Folder with failed copy
+    inside gets current times instead of source ones, so that TRUST_FOLDER_MTIME run does not take it as in sync.
+
+    :param new_folders: list of (source, target) pairs of created folders
+    :param failed_copies: list of target files of failed copies
+    """
+    incomplete_folders = {os.path.dirname(file_target) for file_target in failed_copies}
+    for folder_left, folder_right in new_folders:
+        try:
+            _copystat(folder_left, folder_right)
+            if folder_right in incomplete_folders:
+                os.utime(folder_right)
+        except OSError as exc:
+            logging.warning('! failed to copy folder metadata %s -> %s: %s', folder_left, folder_right, exc)
+
+
+def apply_folder_times(target_folder, folder_times):
+    """
+    Set times of target folders found in sync to the ones of source folders (see BackupShallowDiff.folder_times)
+
+    :param target_folder: backup root
+    :param folder_times: relative folder paths mapped to (atime_ns, mtime_ns)
+    """
+    for folder_key, times in folder_times.items():
+        folder_right = os.path.join(target_folder, folder_key)
+        try:
+            os.utime(folder_right, ns=times)
+        except OSError as exc:
+            logging.warning('! failed to set folder times %s: %s', folder_right, exc)
+
+
+def run_backup(source_path, target_path, args):
+    """
+    Compare source and target folders by built-in compare and apply differences (or just show them in dry-run mode)
+
+    :param source_path: source folder
+    :param target_path: target folder (backup root)
+    :param args: parsed command line
+    """
+    dry_run = args.dry_run
+    # deep compare must not skip anything
+    use_snapshot = args.snapshot and not args.deep
+    compare = DEEP if args.deep else TRUST_FOLDER_MTIME if args.trust_folder_mtime else SHALLOW
+    snapshot = load_snapshot(target_path) if use_snapshot else None
+    diff = BackupShallowDiff(source_path, target_path, snapshot=snapshot, workers=args.scan_jobs, compare=compare)
+    new_folders = []
+    failed_copies = []
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        # run mode is known up front - handlers are picked once instead of checking dry-run for every action
+        if dry_run:
+            handlers = dry_run_handlers()
         else:
-            print('REMOVE: {0}'.format(doomed_file_right))
-            do_remove(doomed_file_right)
+            handlers = backup_handlers(bounded_submitter(pool, args.jobs * _PENDING_PER_WORKER), new_folders,
+                                       failed_copies)
+        for kind, file_left, file_right in diff.walk():
+            handlers[kind](file_left, file_right)
+    copy_folder_metadata(new_folders, failed_copies)
+    if use_snapshot and not dry_run:
+        save_snapshot(target_path, diff.folder_states)
+    if compare == TRUST_FOLDER_MTIME and not dry_run:
+        apply_folder_times(target_path, diff.folder_times)
+
+
+def positive_int(value):
+    """
+    Command line type of worker counts
 
-    print(' {0} '.format(datetime.strftime(datetime.now(), _DATE_TIME_FORM)).center(35, '^'))
+    :param value: command line value
+    :return: value as int
+    :raise argparse.ArgumentTypeError: if value is not positive integer (reported as usage error)
+    """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError('positive integer expected: {0}'.format(value))
+    return number
+
+
+def main():
+    """
+    Parse command line and run one-shot backup (hot loops run on local names)
+    """
+    parser = argparse.ArgumentParser(description='One-shot backup of projects using shallow file compare.')
+    parser.add_argument('--source', type=str, required=True,
+                        help='source folder (with living data inside)')
+    parser.add_argument('--backup-root', type=str, required=True,
+                        help='target folder (with backups)')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='just show what would be copied - no change on file system')
+    parser.add_argument('--verbose', action='store_true',
+                        help='show verbose output')
+    parser.add_argument('--snapshot', action='store_true',
+                        help='skip comparing files of source folders unchanged since previous run (mtime and entry'
+                             ' count) - in-place edits not touching folder mtime are missed')
+    parser.add_argument('--deep', action='store_true',
+                        help='compare files of the same size by content (sha256) instead of mtime - reads both sides')
+    parser.add_argument('--trust-folder-mtime', action='store_true',
+                        help='skip comparing files of folders with the same mtime on both sides (set by previous run'
+                             ' once in sync) - like --snapshot without state file, in-place edits not touching'
+                             ' folder mtime are missed')
+    parser.add_argument('--use-rsync', action='store_true',
+                        help='delegate whole sync to rsync if available (built-in compare is used otherwise)')
+    parser.add_argument('--jobs', type=positive_int, default=_IO_WORKERS,
+                        help='number of parallel copy/remove workers (default: {0})'.format(_IO_WORKERS))
+    parser.add_argument('--scan-jobs', type=positive_int, default=_IO_WORKERS,
+                        help='number of folders compared in parallel - raise for high latency storage like NFS'
+                             ' (default: {0})'.format(_IO_WORKERS))
+
+    argcomplete.autocomplete(parser)
+    args = parser.parse_args()
+    logging.basicConfig(format='%(message)s')
+    # every action prints a line - let them fill the buffer instead of one write call per line on terminal
+    sys.stdout.reconfigure(line_buffering=False)
+    print(' {0} '.format(time.strftime(_DATE_TIME_FORM)).center(35, 'v'))
+
+    if args.verbose:
+        sys.stderr.write('#args: {0}\n'.format(args))
+
+    # same as os.path.abspath, but working folder is looked up once for both paths
+    working_folder = os.getcwd()
+    source_path = os.path.normpath(os.path.join(working_folder, args.source))
+    target_path = os.path.normpath(os.path.join(working_folder, args.backup_root))
+    if args.verbose:
+        sys.stderr.write('#source_path: {0}\n'.format(source_path))
+        sys.stderr.write('#target_path: {0}\n'.format(target_path))
+
+    check_and_create_folder(target_path, dry_run=args.dry_run)
+
+    use_rsync = args.use_rsync and shutil.which('rsync') is not None
+    if args.use_rsync and not use_rsync:
+        logging.warning('! rsync not found - using built-in shallow compare')
+
+    if use_rsync:
+        rsync_code = run_rsync(source_path, target_path, dry_run=args.dry_run)
+        if rsync_code:
+            logging.warning('! rsync failed with exit code %s', rsync_code)
+    else:
+        run_backup(source_path, target_path, args)
+
+    sys.stdout.flush()
+    print(' {0} '.format(time.strftime(_DATE_TIME_FORM)).center(35, '^'))
+
+
+if __name__ == '__main__':
+    main()